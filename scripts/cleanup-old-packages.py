@@ -4,12 +4,14 @@
 """Script to clean up old anaconda packages."""
 
 import argparse
+import functools
 import re
-from collections import defaultdict
-from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 try:
     from binstar_client.utils import bool_input, get_server_api, parse_specs
+    from requests.adapters import HTTPAdapter
 except ImportError:
     raise Exception(
         "Script requires anaconda-clinet. Please install it in "
@@ -26,7 +28,10 @@ QUOTAS = {
     "dppy/dpcpp-llvm-spirv": 256 * 1024 * 1024,
 }
 
+_DEV_RE = re.compile(r"^\d+\.\d+\.\d+\.?(dev|rc)\d+")
 
+
+@functools.lru_cache(maxsize=None)
 def is_dev_version(version: str) -> bool:
     """Checks if input string match dev or rc version pattern (e.g. X.Y.ZdevW).
 
@@ -36,7 +41,7 @@ def is_dev_version(version: str) -> bool:
     Returns:
         True if input version is development version
     """
-    return bool(re.search(r"^\d+\.\d+\.\d+\.?(dev|rc)\d+", version))
+    return _DEV_RE.search(version) is not None
 
 
 def build_number(file) -> int:
@@ -57,18 +62,44 @@ def build_number(file) -> int:
     )
 
 
-def max_build(files: list) -> int:
-    """Returns max build number for the list of files.
-
-    Intended to use for the list of files of the same version.
-
-    Args:
-        files: anacondas' files metadata representing files stored in registry.
+@dataclass(slots=True)
+class PackageFile:
+    """File stored in registry with the metadata used for clean up.
 
-    Returns:
-        Integer build number
+    Attributes:
+        full_name: full name of the file (user/package/version/basename)
+        basename: file name within the package version
+        version: package version of the file
+        size: file size in bytes
+        upload_time: upload time of the file
+        build_no: build number extracted by ``build_number``
     """
-    return max(map(build_number, files), default=0)
+
+    full_name: str
+    basename: str
+    version: str
+    size: int
+    upload_time: str
+    build_no: int
+
+    @classmethod
+    def from_metadata(cls, file) -> "PackageFile":
+        """Creates file from anaconda's file metadata.
+
+        Args:
+            file: anaconda's file metadata representing file stored in registry.
+
+        Returns:
+            PackageFile instance
+        """
+        return cls(
+            full_name=file["full_name"],
+            basename=file["basename"],
+            version=file["version"],
+            size=file["size"],
+            upload_time=file["upload_time"],
+            build_no=build_number(file),
+        )
 
 
 def cleanup_packages(
@@ -103,106 +134,128 @@ def cleanup_packages(
             print(*args)
 
     aserver_api = get_server_api(token, None)
+    # reuse pooled keep-alive connections for the per-file remove requests
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=3)
+    aserver_api.session.mount("http://", adapter)
+    aserver_api.session.mount("https://", adapter)
     spec = parse_specs(package_path)
     package = aserver_api.package(spec.user, spec.package)
 
     versions = package["versions"]
     print_verbose("versions", versions)
 
-    files = package["files"]
-    if label is not None:
-        files = list(filter(lambda a: label in a["labels"], files))
-    files_by_version = defaultdict(lambda: [])
-    for f in files:
-        files_by_version[f["version"]].append(f)
+    # filter, convert and group files in a single pass over the metadata
+    files = []
+    file_ids_by_version = {}
+    max_build_by_version = {}
+    for metadata in package["files"]:
+        if label is not None and label not in metadata["labels"]:
+            continue
+        f = PackageFile.from_metadata(metadata)
+        v, bn = f.version, f.build_no
+        file_ids_by_version.setdefault(v, []).append((len(files), bn))
+        max_build_by_version[v] = max(max_build_by_version.get(v, 0), bn)
+        files.append(f)
 
     # NIT: max does not work on semantic vesrions.
     # last_dev = max(filter(is_dev_version, versions), default=None)
-    last_dev = None
-    for v in versions:
-        if is_dev_version(v):
-            last_dev = v
+    last_dev = next((v for v in reversed(versions) if is_dev_version(v)), None)
 
     print_verbose("last_dev:", last_dev)
 
-    total_size = sum(map(lambda f: f["size"], files))
-    print_verbose("total size:", total_size)
+    # total size is only needed to enforce max_size
+    total_size = 0
+    if max_size is not None:
+        total_size = sum(f.size for f in files)
+        print_verbose("total size:", total_size)
 
+    # cleanup priorities are kept in a list parallel to files
+    priorities = [4] * len(files)
     for version in versions:
         is_dev = is_dev_version(version)
-        mbd = max_build(files_by_version[version])
-
-        for file in files_by_version[version]:
-            prioity = 4
+        mbd = max_build_by_version.get(version, 0)
 
-            if build_number(file) == mbd:
-                if is_dev and file["version"] != last_dev:
-                    prioity = 2
-            elif is_dev and file["version"] == last_dev:
-                prioity = 3
-            elif is_dev:
-                prioity = 0
-            else:
-                prioity = 1
+        # priority depends only on the version and whether the file has the
+        # latest build of it, so resolve both outcomes once per version
+        if version == last_dev:
+            latest_priority, priority = 4, 3
+        elif is_dev:
+            latest_priority, priority = 2, 0
+        else:
+            latest_priority, priority = 4, 1
 
-            file["cleanup_priority"] = prioity
+        for idx, bn in file_ids_by_version.get(version, ()):
+            priorities[idx] = latest_priority if bn == mbd else priority
 
-    for file in files:
+    for file, priority in zip(files, priorities):
         print_verbose(
             "priority:",
-            file["cleanup_priority"],
+            priority,
             "build:",
-            build_number(file),
-            file["full_name"],
+            file.build_no,
+            file.full_name,
         )
     print_verbose("")
 
-    files.sort(key=itemgetter("cleanup_priority", "upload_time"))
+    keys = [(p, f.upload_time) for p, f in zip(priorities, files)]
+    order = sorted(range(len(files)), key=keys.__getitem__)
 
     last_version, last_build = None, None
 
+    have_max_size = max_size is not None
+    have_max_priority = max_priority is not None
+    have_keep_count = keep_count is not None
+    to_remove = []
+
     cleanup_size = 0
-    while len(files) > 0:
-        file = files[0]
-        version, build = file["version"], build_number(file)
+    i = 0
+    while i < len(files):
+        file, priority = files[order[i]], priorities[order[i]]
+        version, build = file.version, file.build_no
 
         # check if we have to remove this file
         need_clean = (
-            (max_size is not None and total_size > max_size)
-            or (
-                max_priority is not None
-                and file["cleanup_priority"] <= max_priority
-            )
-            or (keep_count is not None and len(files) > keep_count)
+            (have_max_size and total_size > max_size)
+            or (have_max_priority and priority <= max_priority)
+            or (have_keep_count and len(files) - i > keep_count)
         )
 
-        # clean up all releases of last removed version
+        # clean up all releases of last removed version. Files are sorted by
+        # priority and total size and remaining count only decrease, so once
+        # need_clean is False it stays False for the rest of the files.
         if not need_clean and (
             last_version is None
             or (last_version != version or last_build != build)
         ):
             last_version, last_build = None, None
             break
-        last_version, last_build = file["version"], build_number(file)
+        last_version, last_build = version, build
 
         if dry_run or force:
-            print_verbose(f"Removing {file['full_name']}", need_clean)
+            print_verbose(f"Removing {file.full_name}", need_clean)
 
         if not dry_run:
-            remove_spec = parse_specs(file["full_name"])
-            msg = "Are you sure you want to remove file %s ?" % (remove_spec,)
+            msg = "Are you sure you want to remove file %s ?" % (
+                file.full_name,
+            )
             if force or bool_input(msg, False):
-                aserver_api.remove_dist(
-                    remove_spec.user,
-                    remove_spec.package,
-                    remove_spec.version,
-                    remove_spec.basename,
-                )
+                to_remove.append(file)
 
         # iterantion
-        files = files[1:]
-        total_size -= file["size"]
-        cleanup_size += file["size"]
+        i += 1
+        total_size -= file.size
+        cleanup_size += file.size
+
+    # removals are independent requests, so overlap their network latency
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda f: aserver_api.remove_dist(
+                    spec.user, spec.package, f.version, f.basename
+                ),
+                to_remove,
+            )
+        )
 
     print_verbose("Cleaned size:", cleanup_size)
 